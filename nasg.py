@@ -13,24 +13,61 @@ import re
 import asyncio
 import sqlite3
 import json
+import threading
+import hashlib
+import functools
+import http.server
+import mmap
+import html
+import gzip
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
+from contextlib import nullcontext
+from contextlib import contextmanager
+from tempfile import mkstemp
 
 from shutil import copy2 as cp
 from shutil import rmtree
 from shutil import copyfileobj
+from shutil import copystat
 from urllib.parse import urlparse
 from collections import namedtuple
 import logging
 
 import arrow
-import langdetect
+from langdetect.detector_factory import (
+    DetectorFactory,
+    PROFILES_DIRECTORY,
+)
 import wand.image
+import wand.resource
 import filetype
 import jinja2
+import jinja2.meta
 import yaml
 
-import frontmatter
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
+try:
+    from pygments import lex
+    from pygments import token as T
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    lex = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from feedgen.feed import FeedGenerator
 from feedgen.entry import FeedEntry
+from lxml import etree
 
 from slugify import slugify
 import requests
@@ -57,6 +94,27 @@ RE_CODE = re.compile(r"^(?:[~`]{3,4}).+$", re.MULTILINE)
 
 RE_PRECODE = re.compile(r'<pre class="([^"]+)"><code>')
 
+RE_CODEBLOCK = re.compile(
+    r'(<pre><code lang="([^"\s]+)[^"]*" class="[^"]+">)(.*?)(</code></pre>)',
+    re.DOTALL,
+)
+
+# things the minifier copies verbatim or drops: comments, and elements
+# whose whitespace matters
+RE_HTMLKEEP = re.compile(
+    r"<!--|<(pre|code|textarea|script|style)\b", re.IGNORECASE
+)
+RE_WHITESPACE = re.compile(r"\s+")
+
+# the per page markers in the prerendered site chrome
+RE_CHROMEURL = re.compile(r"<!--relurl:(.*?)-->")
+RE_CHROMEMENU = re.compile(r"<!--menu:(.*?)-->")
+
+RE_CHROMEPART = re.compile(r"chrome\.part\(['\"]([^'\"]+)['\"]")
+
+RE_FMSTART = re.compile(rb"\s*-{3,}\s*$", re.MULTILINE)
+RE_FMBOUNDARY = re.compile(rb"^-{3,}\s*$", re.MULTILINE)
+
 RE_MYURL = re.compile(
     r'(^(%s[^"]+)$|"(%s[^"]+)")'
     % (settings.site.url, settings.site.url)
@@ -84,54 +142,256 @@ def url2slug(url, limit=200):
     return url[:limit]
 
 
+@functools.lru_cache(maxsize=None)
 def rfc3339todt(rfc3339):
-    """ nice dates for humans """
+    """ nice dates for humans; memoized, the same dates are printed on
+    every listing page """
     t = arrow.get(rfc3339).format("YYYY-MM-DD HH:mm ZZZ")
     return str(t)
 
 
+def epoch2year(epoch):
+    """ UTC year of an epoch, without creating an arrow object """
+    return time.strftime("%Y", time.gmtime(int(epoch)))
+
+
 def extractlicense(url):
     """ extract license name """
     n, e = os.path.splitext(os.path.basename(url))
     return n.upper()
 
 
+@functools.lru_cache(maxsize=None)
+def _relpath(url, baseurl):
+    r = os.path.relpath(url, baseurl)
+    if url.endswith("/") and not r.endswith("/"):
+        r = "%s/%s" % (r, settings.filenames.html)
+    return r
+
+
 def relurl(text, baseurl=None):
+    """ rewrite the absolute URLs of the site to relative ones in a single
+    pass over the text """
     if not baseurl:
         baseurl = settings.site.url
-    for match, standalone, href in RE_MYURL.findall(text):
-        needsquotes = False
-        if len(href):
-            needsquotes = True
-            url = href
+
+    def replace(match):
+        standalone, href = match.group(2, 3)
+        if href:
+            r = '"%s"' % _relpath(href, baseurl)
         else:
-            url = standalone
+            r = _relpath(standalone, baseurl)
+        logger.debug(
+            "RELURL: %s => %s (base: %s)", match.group(1), r, baseurl
+        )
+        return r
 
-        r = os.path.relpath(url, baseurl)
-        if url.endswith("/") and not r.endswith("/"):
-            r = "%s/%s" % (r, settings.filenames.html)
-        if needsquotes:
-            r = '"%s"' % r
-        logger.debug("RELURL: %s => %s (base: %s)", match, r, baseurl)
-        text = text.replace(match, r)
-    return text
+    return RE_MYURL.sub(replace, text)
+
+
+WRITES = {"written": 0, "skipped": 0}
+
+# mkstemp makes files only the owner can read; outputs get the usual mode
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+@contextmanager
+def atomicfile(fpath):
+    """ binary file object that only replaces fpath - in one rename - once
+    everything was written into it, so nothing half written is served """
+    fd, tmp = mkstemp(
+        dir=os.path.dirname(fpath),
+        prefix=".%s." % os.path.basename(fpath),
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, fpath)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def unchanged(fpath, h, size):
+    """ if fpath already has the content with the sha1 h and size bytes;
+    decided from the manifest and a stat call """
+    if not os.path.exists(fpath) or os.path.getsize(fpath) != size:
+        return False
+    built = MANIFEST.get(fpath, {}).get("hash", None)
+    if built is None:
+        # not in the manifest yet: the one time the file is read
+        with open(fpath, "rb") as f:
+            built = hashlib.sha1(f.read()).hexdigest()
+        if built == h:
+            MANIFEST[fpath] = dict(MANIFEST.get(fpath, {}), hash=h)
+    return built == h
 
 
 def writepath(fpath, content, mtime=0):
-    """ f.write with extras """
-    d = os.path.dirname(fpath)
-    if not os.path.isdir(d):
-        logger.debug("creating directory tree %s", d)
-        os.makedirs(d)
+    """ f.write with extras; leaves files alone if their content would not
+    change, so they keep their mtime and rsync can skip them """
     if isinstance(content, str):
-        mode = "wt"
+        content = content.encode("utf-8")
+    h = hashlib.sha1(content).hexdigest()
+    if unchanged(fpath, h, len(content)):
+        logger.debug("%s is unchanged, not writing it", fpath)
+        WRITES["skipped"] += 1
+        COMPRESSOR.put(fpath, content, h)
+        return
+
+    WRITES["written"] += 1
+    MANIFEST[fpath] = dict(MANIFEST.get(fpath, {}), hash=h)
+    WRITER.put(fpath, content, mtime, h)
+
+
+def streampath(fpath, chunks):
+    """ writepath for content that comes in chunks, eg. from a template
+    stream: the chunks go to a temporary file as they come, so the whole of
+    the content is never in memory, and it replaces fpath only if differs """
+    d = os.path.dirname(fpath)
+    WRITER.mkdir(d)
+    sha1 = hashlib.sha1()
+    size = 0
+    fd, tmp = mkstemp(dir=d, prefix=".%s." % os.path.basename(fpath))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                chunk = chunk.encode("utf-8")
+                sha1.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    h = sha1.hexdigest()
+    if unchanged(fpath, h, size):
+        logger.debug("%s is unchanged, not writing it", fpath)
+        os.unlink(tmp)
+        WRITES["skipped"] += 1
     else:
-        mode = "wb"
-    with open(fpath, mode) as f:
         logger.info("writing file %s", fpath)
-        f.write(content)
-        if mtime > 0:
-            os.utime(fpath, (mtime, mtime))
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, fpath)
+        WRITES["written"] += 1
+        MANIFEST[fpath] = dict(MANIFEST.get(fpath, {}), hash=h)
+    COMPRESSOR.put(fpath, None, h, size)
+
+
+class HTMLMinifier(object):
+    """
+    Collapses whitespace and strips comments from HTML fed to it in chunks;
+    the content of pre, code, textarea, script and style elements and
+    conditional comments are left alone. What is saved is counted per page
+    type.
+    """
+
+    stats = {}
+    lock = threading.Lock()
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.rest = ""
+        self.size = 0
+        self.minified = 0
+
+    @staticmethod
+    def collapse(text):
+        return RE_WHITESPACE.sub(
+            lambda m: "\n" if "\n" in m.group(0) else " ", text
+        )
+
+    def process(self, text, final=False):
+        r = []
+        pos = 0
+        while True:
+            m = RE_HTMLKEEP.search(text, pos)
+            if not m:
+                break
+            r.append(self.collapse(text[pos : m.start()]))
+            if m.group(1):
+                end = re.compile(
+                    r"</%s\s*>" % m.group(1), re.IGNORECASE
+                ).search(text, m.end())
+                end = end.end() if end else -1
+            else:
+                end = text.find("-->", m.end())
+                end = end + 3 if end > -1 else -1
+            if end == -1:
+                # the closing tag is in a later chunk
+                pos = m.start()
+                if final:
+                    r.append(text[pos:])
+                    pos = len(text)
+                self.rest = text[pos:]
+                return "".join(r)
+            if m.group(1) or text.startswith("<!--[if", m.start()):
+                r.append(text[m.start() : end])
+            pos = end
+
+        tail = text[pos:]
+        if final:
+            cut = len(tail)
+        else:
+            # hold back what could be the start of a tag or a whitespace run
+            # continuing in the next chunk
+            cut = tail.rfind("<")
+            if cut == -1 or ">" in tail[cut:]:
+                cut = len(tail.rstrip())
+        r.append(self.collapse(tail[:cut]))
+        self.rest = tail[cut:]
+        return "".join(r)
+
+    def feed(self, chunk):
+        self.size += len(chunk.encode("utf-8"))
+        r = self.process(self.rest + chunk)
+        self.minified += len(r.encode("utf-8"))
+        return r
+
+    def close(self):
+        r = self.process(self.rest, final=True)
+        self.minified += len(r.encode("utf-8"))
+        with self.lock:
+            pages, size, minified = self.stats.get(self.kind, (0, 0, 0))
+            self.stats[self.kind] = (
+                pages + 1,
+                size + self.size,
+                minified + self.minified,
+            )
+        return r
+
+    @classmethod
+    def report(cls):
+        for kind, (pages, size, minified) in sorted(cls.stats.items()):
+            logger.info(
+                "minified %d %s pages: %d => %d bytes, %d saved",
+                pages,
+                kind,
+                size,
+                minified,
+                size - minified,
+            )
+
+
+def minify(text, kind):
+    """ minify a whole page if settings say so """
+    if not settings.minify.html:
+        return text
+    m = HTMLMinifier(kind)
+    return m.feed(text) + m.close()
+
+
+def minified(chunks, kind):
+    """ minify a page rendered in chunks if settings say so """
+    if not settings.minify.html:
+        yield from chunks
+        return
+    m = HTMLMinifier(kind)
+    for chunk in chunks:
+        yield m.feed(chunk)
+    yield m.close()
 
 
 def maybe_copy(source, target):
@@ -147,12 +407,35 @@ def extractdomain(url):
     return url.hostname
 
 
+for k, v in settings.imagemagick.items():
+    wand.resource.limits[k] = v
+
+# resizing happens on a thread pool; images above settings.photo.huge pixels
+# are additionally limited by a semaphore so a few gigantic panoramas can't
+# eat all the memory at the same time
+IMGPOOL = ThreadPoolExecutor(max_workers=settings.photo.workers)
+HUGEIMAGES = threading.BoundedSemaphore(settings.photo.hugeworkers)
+
+# in preview mode resized images are only registered here, keyed by their
+# path, and made by the preview server on their first request; LAZYJOBS has
+# the ones being made, for other requests of the same path to wait on
+LAZY = {}
+LAZYJOBS = {}
+LAZYLOCK = threading.Lock()
+
+# compiled templates survive between runs, so a fresh process only has to
+# compile what changed since the last one
+J2CACHE = os.path.join(settings.tmpdir, "jinja2")
+if not os.path.isdir(J2CACHE):
+    os.makedirs(J2CACHE)
+
 J2 = jinja2.Environment(
     loader=jinja2.FileSystemLoader(
         searchpath=settings.paths.get("tmpl")
     ),
     lstrip_blocks=True,
     trim_blocks=True,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(J2CACHE),
 )
 J2.filters["relurl"] = relurl
 J2.filters["url2slug"] = url2slug
@@ -180,25 +463,584 @@ class cached_property(object):
         return result
 
 
+class LangDetect(object):
+    """
+    langdetect, but with the profiles loaded only once per process, a fixed
+    seed, so the same text always gets the same language, and detecting on a
+    limited sample of the text only. Detectors are created per call, so it
+    can be shared between threads.
+    """
+
+    def __init__(self):
+        self.factory = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.factory:
+                return
+            factory = DetectorFactory()
+            factory.seed = settings.lang.seed
+            factory.load_profile(PROFILES_DIRECTORY)
+            self.factory = factory
+
+    def detect(self, text):
+        if not self.factory:
+            self.load()
+        detector = self.factory.create()
+        detector.append(text[: settings.lang.sample])
+        return detector.detect()
+
+
+LANG = LangDetect()
+
+
 class AQ:
-    """ Async queue which starts execution right on population """
+    """ Async queue which collects tasks and runs them together on run() """
 
     def __init__(self):
         self.loop = asyncio.get_event_loop()
-        self.queue = asyncio.Queue(loop=self.loop)
+        self.queue = []
 
     def put(self, task):
-        self.queue.put(asyncio.ensure_future(task))
-
-    async def consume(self):
-        while not self.queue.empty():
-            item = await self.queue.get()
-            self.queue.task_done()
-        # asyncio.gather() ?
+        self.queue.append(task)
 
     def run(self):
-        consumer = asyncio.ensure_future(self.consume())
-        self.loop.run_until_complete(consumer)
+        tasks = self.queue
+        self.queue = []
+        self.loop.run_until_complete(asyncio.gather(*tasks))
+
+
+class ImageIndex(object):
+    """
+    Content hash index of the images referenced by posts, and the records
+    of what's derived from them (see WebImage.record).
+
+    The hashes are persisted between builds, keyed by path, and only
+    recalculated if the file's mtime or size changed. The first image with a
+    given hash is the primary one: only that one is read by exiftool and
+    resized, the others get hardlinks to its resized variants. The paths of
+    those variants are kept as well, so an image that first appears in a
+    new post is linked to them even if the post of its primary is not
+    loaded in this build.
+    """
+
+    def __init__(self):
+        self.fpath = os.path.join(settings.tmpdir, "images.json")
+        self.files = {}
+        self.records = {}
+        self.variants = {}
+        self.primaries = {}
+        self.used = set()
+        self.is_changed = False
+        if os.path.exists(self.fpath):
+            with open(self.fpath, "rt") as f:
+                data = json.loads(f.read())
+                self.files = data.get("files", {})
+                self.records = data.get("records", {})
+                self.variants = data.get("variants", {})
+
+    def hash(self, fpath):
+        self.used.add(fpath)
+        stat = os.stat(fpath)
+        cached = self.files.get(fpath, {})
+        if (
+            cached.get("mtime") == int(stat.st_mtime)
+            and cached.get("size") == stat.st_size
+        ):
+            return cached["hash"]
+
+        h = hashlib.sha1()
+        with open(fpath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        self.files[fpath] = {
+            "mtime": int(stat.st_mtime),
+            "size": stat.st_size,
+            "hash": h.hexdigest(),
+        }
+        self.is_changed = True
+        return self.files[fpath]["hash"]
+
+    def primary(self, img):
+        p = self.primaries.setdefault(img.hash, img)
+        if p.fpath == img.fpath:
+            return img
+        logger.debug("%s is a duplicate of %s", img.fpath, p.fpath)
+        return p
+
+    def built(self, img):
+        """ the resized variants an image with the same content got in an
+        earlier build, if they are all still there """
+        if settings.args.get("regenerate"):
+            return []
+        paths = self.variants.get(img.hash, [])
+        if len(paths) != len(img.variants):
+            return []
+        if paths == [resized.fpath for size, resized in img.variants]:
+            return []
+        if not all([os.path.exists(p) for p in paths]):
+            return []
+        logger.debug(
+            "%s was already resized as %s", img.fpath, paths[0]
+        )
+        return paths
+
+    def add_variants(self, img):
+        paths = [resized.fpath for size, resized in img.variants]
+        if self.variants.get(img.hash, None) == paths:
+            return
+        # the files now have the content of this image, not the old one's
+        for h, old in list(self.variants.items()):
+            if set(old) & set(paths):
+                del self.variants[h]
+        self.variants[img.hash] = paths
+        self.is_changed = True
+
+    def prune(self):
+        """ drop everything about images no post used since start; only
+        meaningful after a build that loaded every post """
+        self.files = {
+            k: v for k, v in self.files.items() if k in self.used
+        }
+        hashes = set([v["hash"] for v in self.files.values()])
+        for d in [self.records, self.variants]:
+            for h in set(d.keys()) - hashes:
+                del d[h]
+        self.is_changed = True
+
+    def save(self):
+        if not self.is_changed:
+            return
+        with open(self.fpath, "wt") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "files": self.files,
+                        "records": self.records,
+                        "variants": self.variants,
+                    },
+                    indent=4,
+                    sort_keys=True,
+                )
+            )
+        self.is_changed = False
+
+
+IMAGES = ImageIndex()
+
+
+class PersistentDict(dict):
+    """ dict that is stored as JSON in the tmpdir between builds """
+
+    fname = None
+
+    def __init__(self):
+        self.fpath = os.path.join(settings.tmpdir, self.fname)
+        self.is_changed = False
+        self.used = set()
+        if os.path.exists(self.fpath):
+            with open(self.fpath, "rt") as f:
+                dict.update(self, json.loads(f.read()))
+
+    def __setitem__(self, key, value):
+        self.is_changed = True
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.is_changed = True
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.is_changed = True
+        return dict.pop(self, key, *default)
+
+    def use(self, key):
+        self.used.add(key)
+
+    def prune(self):
+        """ drop the entries nothing asked for with use() since loading """
+        for key in set(self.keys()) - self.used:
+            del self[key]
+
+    def save(self):
+        if not self.is_changed:
+            return
+        with open(self.fpath, "wt") as f:
+            f.write(json.dumps(self, indent=4, sort_keys=True))
+        self.is_changed = False
+
+
+class PostIndex(PersistentDict):
+    """
+    Expensive, derived data of posts - language, code detection, dates,
+    short slug - keyed by the content hash of their markdown file and
+    persisted between builds, so unchanged posts don't redo any of it.
+    Entries also hold the hashes of the images they were made with: the
+    type and the date of photo posts come from the EXIF of the photo.
+    """
+
+    fname = "posts.json"
+
+
+POSTS = PostIndex()
+
+
+class Manifest(PersistentDict):
+    """
+    What the output files were built from and the hash of what was written
+    into them, keyed by the path of the output; this is what lets posts
+    decide if they need rendering from stat calls only, and writepath skip
+    writing what wouldn't change.
+    """
+
+    fname = "manifest.json"
+
+
+MANIFEST = Manifest()
+
+
+class Highlighter(PersistentDict):
+    """
+    Build time syntax highlighting: code blocks become the same token spans
+    prism.js would make in the browser, so prism.css styles them and code
+    pages need no JavaScript. Results are keyed by the hash of the language
+    and the code.
+    """
+
+    fname = "highlight.json"
+
+    # pygments token type => prism.css class; unlisted types use the class
+    # of their closest listed parent
+    tokens = (
+        {
+            T.Comment: "comment",
+            T.Comment.Preproc: "prolog",
+            T.Keyword: "keyword",
+            T.Keyword.Constant: "boolean",
+            T.Keyword.Type: "builtin",
+            T.Name.Builtin: "builtin",
+            T.Name.Function: "function",
+            T.Name.Decorator: "function",
+            T.Name.Class: "class-name",
+            T.Name.Tag: "tag",
+            T.Name.Attribute: "attr-name",
+            T.Name.Variable: "variable",
+            T.Name.Constant: "constant",
+            T.Name.Entity: "entity",
+            T.Name.Property: "property",
+            T.String: "string",
+            T.String.Char: "char",
+            T.String.Regex: "regex",
+            T.String.Symbol: "symbol",
+            T.Number: "number",
+            T.Operator: "operator",
+            T.Operator.Word: "keyword",
+            T.Punctuation: "punctuation",
+            T.Generic.Deleted: "deleted",
+            T.Generic.Inserted: "inserted",
+            T.Generic.Heading: "important",
+            T.Generic.Strong: "bold",
+            T.Generic.Emph: "italic",
+        }
+        if lex
+        else {}
+    )
+
+    @property
+    def enabled(self):
+        return settings.highlight.build and lex is not None
+
+    def css(self, ttype):
+        while ttype not in self.tokens and ttype.parent is not None:
+            ttype = ttype.parent
+        return self.tokens.get(ttype, None)
+
+    def highlight(self, lang, code):
+        """ code is, like pandoc leaves it, HTML escaped """
+        key = hashlib.sha1(
+            ("%s\0%s" % (lang, code)).encode()
+        ).hexdigest()
+        self.use(key)
+        if key in self:
+            return self[key]
+        try:
+            lexer = get_lexer_by_name(
+                lang, stripnl=False, ensurenl=False
+            )
+        except ClassNotFound:
+            logger.debug("no lexer for %s, leaving code as is", lang)
+            return code
+        # neighbouring tokens of the same class share a span
+        spans = []
+        for ttype, value in lex(html.unescape(code), lexer):
+            css = self.css(ttype)
+            if spans and spans[-1][0] == css:
+                spans[-1][1] += value
+            else:
+                spans.append([css, value])
+        r = []
+        for css, value in spans:
+            value = html.escape(value, quote=False)
+            if css:
+                r.append(
+                    '<span class="token %s">%s</span>' % (css, value)
+                )
+            else:
+                r.append(value)
+        self[key] = "".join(r)
+        return self[key]
+
+    def sub(self, text):
+        if not self.enabled:
+            return text
+
+        def replace(match):
+            start, lang, code, end = match.group(1, 2, 3, 4)
+            return "%s%s%s" % (start, self.highlight(lang, code), end)
+
+        return RE_CODEBLOCK.sub(replace, text)
+
+
+HIGHLIGHTER = Highlighter()
+J2.globals["highlighted"] = HIGHLIGHTER.enabled
+
+
+class Compressor(PersistentDict):
+    """
+    Precompressed .gz and .br siblings of text outputs for nginx's
+    gzip_static and brotli_static, made on a thread pool; keyed by output
+    path, it holds the hash of the content the siblings were made from, so
+    they are only redone if that changes.
+    """
+
+    fname = "compressed.json"
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(
+            max_workers=settings.compress.workers
+        )
+        self.jobs = []
+
+    @property
+    def suffixes(self):
+        r = []
+        if settings.compress.gzip:
+            r.append(".gz")
+        if settings.compress.brotli and brotli:
+            r.append(".br")
+        return r
+
+    def drop(self, fpath, keep=()):
+        """ remove the siblings of fpath that are not in keep; nginx would
+        serve a leftover one instead of the current file """
+        for suffix in [".gz", ".br"]:
+            if suffix in keep:
+                continue
+            sibling = "%s%s" % (fpath, suffix)
+            if os.path.exists(sibling):
+                logger.debug("removing stale %s", sibling)
+                os.unlink(sibling)
+        if not keep:
+            with self.lock:
+                self.pop(fpath, None)
+
+    def put(self, fpath, content, h, size=None):
+        """ content is bytes, h is its sha1; without content the file is
+        read back when it's compressed """
+        if size is None:
+            size = len(content)
+        if (
+            not self.suffixes
+            or os.path.splitext(fpath)[1]
+            not in settings.compress.extensions
+            or size < settings.compress.minsize
+        ):
+            self.drop(fpath)
+            return
+        self.drop(fpath, self.suffixes)
+        if self.get(fpath) == h and all(
+            os.path.exists("%s%s" % (fpath, s)) for s in self.suffixes
+        ):
+            return
+        self.jobs.append(
+            self.pool.submit(self.compress, fpath, content, h)
+        )
+
+    def compress(self, fpath, content, h):
+        if content is None:
+            with open(fpath, "rb") as f:
+                content = f.read()
+        for suffix in self.suffixes:
+            if suffix == ".gz":
+                c = gzip.compress(content, compresslevel=9, mtime=0)
+            else:
+                c = brotli.compress(content, mode=brotli.MODE_TEXT)
+            with atomicfile("%s%s" % (fpath, suffix)) as f:
+                f.write(c)
+            # nginx wants the sibling to be as fresh as the original
+            copystat(fpath, "%s%s" % (fpath, suffix))
+        logger.debug("compressed %s", fpath)
+        with self.lock:
+            self[fpath] = h
+
+    def wait(self):
+        for job in self.jobs:
+            job.result()
+        self.jobs = []
+        self.save()
+
+
+COMPRESSOR = Compressor()
+
+
+class OutputWriter(object):
+    """
+    Writes outputs on a thread pool, off the render path, each through
+    atomicfile; directories are only created the first time they're seen.
+    If a path is queued again before it was written, only the newest
+    content is written. flush() is the barrier to call before anything
+    reads the build directory.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(
+            max_workers=settings.writer.workers
+        )
+        self.dirs = set()
+        self.pending = {}
+        self.jobs = []
+
+    def put(self, fpath, content, mtime, h):
+        with self.lock:
+            queued = fpath in self.pending
+            self.pending[fpath] = (content, mtime, h)
+        if not queued:
+            self.jobs.append(self.pool.submit(self.write, fpath))
+
+    def mkdir(self, d):
+        with self.lock:
+            if d in self.dirs:
+                return
+            if not os.path.isdir(d):
+                logger.debug("creating directory tree %s", d)
+                os.makedirs(d, exist_ok=True)
+            self.dirs.add(d)
+
+    def write(self, fpath):
+        self.mkdir(os.path.dirname(fpath))
+        with self.lock:
+            content, mtime, h = self.pending.pop(fpath)
+        with atomicfile(fpath) as f:
+            logger.info("writing file %s", fpath)
+            f.write(content)
+        if mtime > 0:
+            os.utime(fpath, (mtime, mtime))
+        COMPRESSOR.put(fpath, content, h)
+
+    def flush(self):
+        while self.jobs:
+            jobs, self.jobs = self.jobs, []
+            for job in jobs:
+                job.result()
+
+
+WRITER = OutputWriter()
+
+
+class FragmentCache(object):
+    """
+    Rendered HTML fragments - image blocks, comments, article bodies - in
+    SQLite, keyed by their kind and the hash of everything they're made
+    from, templates included. A post re-rendered because of a new comment
+    gets its body and images from here, and only the new comment is
+    rendered. A --force build renders everything, so whatever it didn't
+    ask for is dropped after it.
+    """
+
+    def __init__(self):
+        self.fpath = os.path.join(settings.tmpdir, "fragments.sqlite")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.fpath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = MEMORY;")
+        self.db.execute("PRAGMA temp_store = MEMORY;")
+        self.db.execute('PRAGMA encoding = "UTF-8";')
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fragments (
+                key TEXT PRIMARY KEY,
+                html TEXT
+            )"""
+        )
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def template(name):
+        """ hash of the source of a template """
+        source, _, _ = J2.loader.get_source(J2, name)
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def get(self, kind, inputs, make):
+        """ the fragment made from inputs, or make() it if there's none """
+        key = "%s:%s" % (
+            kind,
+            hashlib.sha1(
+                json.dumps(inputs, sort_keys=True, default=str).encode()
+            ).hexdigest(),
+        )
+        with self.lock:
+            self.used.add(key)
+        if not settings.args.get("force"):
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT html FROM fragments WHERE key = ?", (key,)
+                ).fetchone()
+            if row:
+                self.hits += 1
+                return row[0]
+
+        html = make()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO fragments (key, html) VALUES (?, ?)",
+                (key, html),
+            )
+        self.misses += 1
+        return html
+
+    def prune(self):
+        """ drop the fragments that were not asked for since start; only
+        meaningful after a build that rendered everything """
+        with self.lock:
+            keys = [
+                row[0]
+                for row in self.db.execute("SELECT key FROM fragments")
+                if row[0] not in self.used
+            ]
+            self.db.executemany(
+                "DELETE FROM fragments WHERE key = ?",
+                [(key,) for key in keys],
+            )
+            self.db.commit()
+            self.db.execute("VACUUM")
+        logger.info("fragments: %d unused ones removed", len(keys))
+
+    def save(self):
+        with self.lock:
+            self.db.commit()
+        logger.info(
+            "fragments: %d reused, %d rendered", self.hits, self.misses
+        )
+
+
+FRAGMENTS = FragmentCache()
 
 
 class Gone(object):
@@ -333,7 +1175,7 @@ class MarkdownDoc(object):
     def mtime(self):
         return mtime(self.fpath)
 
-    @property
+    @cached_property
     def dt(self):
         """ returns an arrow object; tries to get the published date of the
         markdown doc. The pubdate can be in the future, which is why it's
@@ -357,19 +1199,44 @@ class MarkdownDoc(object):
         return maybe
 
     @cached_property
-    def _parsed(self):
-        with open(self.fpath, mode="rt") as f:
-            logger.debug("parsing YAML+MD file %s", self.fpath)
-            meta, txt = frontmatter.parse(f.read())
-        return (meta, txt)
+    def hash(self):
+        with open(self.fpath, mode="rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    @cached_property
+    def _header(self):
+        """ the YAML frontmatter, parsed, and the byte offset of the
+        markdown body; only reads the file up to the closing --- """
+        with open(self.fpath, mode="rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return ({}, 0)
+            with mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mm:
+                start = RE_FMSTART.match(mm)
+                if not start:
+                    return ({}, 0)
+                end = RE_FMBOUNDARY.search(mm, start.end())
+                if not end:
+                    return ({}, 0)
+                header = mm[start.end() : end.start()].decode("utf-8")
+                offset = end.end()
+        logger.debug("parsing YAML header of %s", self.fpath)
+        meta = yaml.load(header, Loader=YAMLLoader)
+        if not isinstance(meta, dict):
+            meta = {}
+        return (meta, offset)
 
     @cached_property
     def meta(self):
-        return self._parsed[0]
+        return self._header[0]
 
     @cached_property
     def content(self):
-        maybe = self._parsed[1]
+        with open(self.fpath, mode="rb") as f:
+            f.seek(self._header[1])
+            maybe = f.read().decode("utf-8")
+        maybe = maybe.replace("\r\n", "\n").replace("\r", "\n").strip()
         if not maybe or not len(maybe):
             maybe = str("")
         return maybe
@@ -379,18 +1246,28 @@ class MarkdownDoc(object):
         if not len(self.content):
             return self.content
 
-        c = self.content
+        replacements = []
         if hasattr(self, "images") and len(self.images):
             for match, img in self.images.items():
                 if self.is_photo:
-                    c = c.replace(match, "")
+                    replacements.append((match, ""))
                 else:
-                    c = c.replace(match, str(img))
+                    replacements.append((match, str(img)))
+        return FRAGMENTS.get(
+            "body",
+            [self.content, replacements, HIGHLIGHTER.enabled],
+            lambda: self._html_content(replacements),
+        )
+
+    def _html_content(self, replacements):
+        c = self.content
+        for match, replacement in replacements:
+            c = c.replace(match, replacement)
         c = str(PandocMD2HTML(c))
         c = RE_PRECODE.sub(
             '<pre><code lang="\g<1>" class="language-\g<1>">', c
         )
-        return c
+        return HIGHLIGHTER.sub(c)
 
     @cached_property
     def txt_content(self):
@@ -401,7 +1278,7 @@ class MarkdownDoc(object):
 
 
 class Comment(MarkdownDoc):
-    @property
+    @cached_property
     def dt(self):
         maybe = self.meta.get("date")
         if not maybe or maybe == "null":
@@ -455,6 +1332,17 @@ class Comment(MarkdownDoc):
         }
         return r
 
+    def html(self, posturl):
+        """ the comment's entry in the responses of its post """
+        tmpl = "%s.j2.html" % (self.__class__.__name__)
+        return FRAGMENTS.get(
+            "comment",
+            [self.fpath, self.hash, posturl, FRAGMENTS.template(tmpl)],
+            lambda: J2.get_template(tmpl).render(
+                {"comment": self.jsonld, "post": {"url": posturl}}
+            ),
+        )
+
 
 class WebImage(object):
     def __init__(self, fpath, mdimg, parent):
@@ -465,6 +1353,8 @@ class WebImage(object):
         self.mtime = mtime(self.fpath)
         self.name = os.path.basename(self.fpath)
         self.fname, self.fext = os.path.splitext(self.name)
+        self.hash = IMAGES.hash(self.fpath)
+        self.primary = IMAGES.primary(self)
         self.resized_images = [
             (k, self.Resized(self, k))
             for k in settings.photo.get("sizes").keys()
@@ -477,6 +1367,11 @@ class WebImage(object):
                     self.Resized(self, max(self.width, self.height)),
                 )
             )
+        self.thumbnails = [
+            (k, self.Resized(self, k, crop=True))
+            for k in sorted(settings.photo.get("thumbnails").keys())
+            if k <= min(self.width, self.height)
+        ]
 
     @property
     def is_mainimg(self):
@@ -484,7 +1379,7 @@ class WebImage(object):
             return True
         return False
 
-    @property
+    @cached_property
     def jsonld(self):
         r = {
             "@context": "http://schema.org",
@@ -500,6 +1395,9 @@ class WebImage(object):
                     "height": self.displayed.height,
                 }
             ),
+            "thumbnailUrl": (
+                self.thumbnail.url if self.thumbnail else ""
+            ),
             "name": self.name,
             "encodingFormat": self.mime_type,
             "contentSize": self.mime_size,
@@ -559,61 +1457,129 @@ class WebImage(object):
     def __str__(self):
         if len(self.mdimg.css):
             return self.mdimg.match
-        tmpl = J2.get_template("%s.j2.html" % (self.__class__.__name__))
-        return tmpl.render(self.jsonld)
+        return self.html
+
+    @cached_property
+    def html(self):
+        tmpl = "%s.j2.html" % (self.__class__.__name__)
+        # text is where Singular.jsonld puts this very HTML
+        ld = {k: v for k, v in self.jsonld.items() if k != "text"}
+        return FRAGMENTS.get(
+            "image",
+            [ld, FRAGMENTS.template(tmpl)],
+            lambda: J2.get_template(tmpl).render(self.jsonld),
+        )
+
+    @cached_property
+    def presized(self):
+        """ paths of resized variants identical to ours: those of the
+        primary, or those of the same image resized in an earlier build """
+        if self.primary is not self:
+            return [
+                resized.fpath for size, resized in self.primary.variants
+            ]
+        return IMAGES.built(self)
+
+    @property
+    def is_duplicate(self):
+        return len(self.presized) > 0
 
     @cached_property
     def meta(self):
+        if self.primary is not self:
+            return self.primary.meta
         return Exif(self.fpath)
 
+    @cached_property
+    def record(self):
+        """
+        Everything derived from the image file itself; stored in the image
+        index by content hash, so duplicates and later builds don't need to
+        touch the EXIF data at all
+        """
+        r = IMAGES.records.get(self.hash, None)
+        if r and not settings.args.get("regenerate"):
+            return r
+
+        is_photo = self._is_photo()
+        r = {
+            "width": int(self.meta.get("ImageWidth")),
+            "height": int(self.meta.get("ImageHeight")),
+            "mime_type": str(self.meta.get("MIMEType", "image/jpeg")),
+            "file_type": self.meta.get("FileType", "jpeg"),
+            "file_size": self.meta.get("FileSize", 0),
+            "description": self.meta.get("Description", ""),
+            "headline": self.meta.get("Headline", None),
+            "subject": list(set(self.meta.get("Subject", []))),
+            "released": self.meta.get(
+                "ReleaseDate", self.meta.get("ModifyDate")
+            ),
+            "is_photo": is_photo,
+            "exif": self._exif(is_photo),
+        }
+        IMAGES.records[self.hash] = r
+        IMAGES.is_changed = True
+        return r
+
+    def _forget_variants(self):
+        """ resized files changed: drop what was derived from them """
+        self.record.pop("mime_size", None)
+        IMAGES.is_changed = True
+        self.__dict__.pop("jsonld", None)
+
     @property
     def caption(self):
         if len(self.mdimg.alt):
             return self.mdimg.alt
         else:
-            return self.meta.get("Description", "")
+            return self.record["description"]
 
     @property
     def title(self):
         if len(self.mdimg.title):
             return self.mdimg.title
+        elif self.record["headline"] is None:
+            return self.fname
         else:
-            return self.meta.get("Headline", self.fname)
+            return self.record["headline"]
 
     @property
     def tags(self):
-        return list(set(self.meta.get("Subject", [])))
+        return self.record["subject"]
 
     @property
     def published(self):
-        return arrow.get(
-            self.meta.get("ReleaseDate", self.meta.get("ModifyDate"))
-        )
+        return arrow.get(self.record["released"])
 
     @property
     def width(self):
-        return int(self.meta.get("ImageWidth"))
+        return self.record["width"]
 
     @property
     def height(self):
-        return int(self.meta.get("ImageHeight"))
+        return self.record["height"]
 
     @property
     def mime_type(self):
-        return str(self.meta.get("MIMEType", "image/jpeg"))
+        return self.record["mime_type"]
 
     @property
     def mime_size(self):
+        if "mime_size" in self.record:
+            return self.record["mime_size"]
         try:
             size = os.path.getsize(self.linked.fpath)
         except Exception as e:
-            logger.error(
-                "Failed to get mime size of %s", self.linked.fpath
-            )
-            size = self.meta.get("FileSize", 0)
+            if self.linked.fpath not in LAZY:
+                logger.error(
+                    "Failed to get mime size of %s", self.linked.fpath
+                )
+            return self.record["file_size"]
+        self.record["mime_size"] = size
+        IMAGES.is_changed = True
         return size
 
-    @property
+    @cached_property
     def displayed(self):
         ret = self.resized_images[0][1]
         for size, r in self.resized_images:
@@ -621,7 +1587,7 @@ class WebImage(object):
                 ret = r
         return ret
 
-    @property
+    @cached_property
     def linked(self):
         m = 0
         ret = self.resized_images[0][1]
@@ -631,6 +1597,18 @@ class WebImage(object):
                 ret = r
         return ret
 
+    @property
+    def thumbnail(self):
+        """ the smallest square thumbnail, if the image is big enough to
+        have any """
+        if not len(self.thumbnails):
+            return None
+        return self.thumbnails[0][1]
+
+    @property
+    def variants(self):
+        return self.resized_images + self.thumbnails
+
     @property
     def src(self):
         return self.displayed.url
@@ -641,6 +1619,13 @@ class WebImage(object):
 
     @property
     def is_photo(self):
+        return self.record["is_photo"]
+
+    @property
+    def exif(self):
+        return settings.nameddict(self.record["exif"])
+
+    def _is_photo(self):
         r = settings.photo.get("re_author", None)
         if not r:
             return False
@@ -654,8 +1639,7 @@ class WebImage(object):
             return True
         return False
 
-    @property
-    def exif(self):
+    def _exif(self, is_photo):
         exif = {
             "Model": "",
             "FNumber": "",
@@ -667,7 +1651,7 @@ class WebImage(object):
             "GPSLatitude": 0,
             "GPSLongitude": 0,
         }
-        if not self.is_photo:
+        if not is_photo:
             return exif
 
         mapping = {
@@ -690,7 +1674,7 @@ class WebImage(object):
                 else:
                     exif[ekey] = maybe
                 break
-        return settings.nameddict(exif)
+        return exif
 
     def _maybe_watermark(self, img):
         if not self.is_photo:
@@ -700,15 +1684,19 @@ class WebImage(object):
         if not os.path.exists(wmarkfile):
             return img
 
+        # use the dimensions of the decoded image: huge ones are read at a
+        # reduced scale, see is_huge
+        width = img.width
+        height = img.height
         with wand.image.Image(filename=wmarkfile) as wmark:
-            w = self.height * 0.2
+            w = height * 0.2
             h = wmark.height * (w / wmark.width)
-            if self.width > self.height:
-                x = self.width - w - (self.width * 0.01)
-                y = self.height - h - (self.height * 0.01)
+            if width > height:
+                x = width - w - (width * 0.01)
+                y = height - h - (height * 0.01)
             else:
-                x = self.width - h - (self.width * 0.01)
-                y = self.height - w - (self.height * 0.01)
+                x = width - h - (width * 0.01)
+                y = height - w - (height * 0.01)
 
             w = round(w)
             h = round(h)
@@ -716,33 +1704,98 @@ class WebImage(object):
             y = round(y)
 
             wmark.resize(w, h)
-            if self.width <= self.height:
+            if width <= height:
                 wmark.rotate(-90)
             img.composite(image=wmark, left=x, top=y)
         return img
 
-    async def downsize(self):
-        need = False
-        for size, resized in self.resized_images:
-            if not resized.exists or settings.args.get("regenerate"):
-                need = True
-                break
-        if not need:
-            return
+    @property
+    def is_huge(self):
+        return (self.width * self.height) > settings.photo.huge
+
+    def _read(self):
+        """ open the original; huge JPEGs are decoded at a reduced scale
+        which is still larger, than the largest resized version """
+        img = wand.image.Image()
+        if self.is_huge and self.mime_type == "image/jpeg":
+            img.options["jpeg:size"] = "%dx%d" % (
+                self.linked.width,
+                self.linked.height,
+            )
+        img.read(filename=self.fpath)
+        return img
 
-        with wand.image.Image(filename=self.fpath) as img:
+    def _downsize(self, variants):
+        limit = HUGEIMAGES if self.is_huge else nullcontext()
+        with limit, self._read() as img:
             img.auto_orient()
             img = self._maybe_watermark(img)
-            for size, resized in self.resized_images:
-                if not resized.exists or settings.args.get(
-                    "regenerate"
-                ):
-                    logger.info(
-                        "resizing image: %s to size %d",
-                        os.path.basename(self.fpath),
-                        size,
-                    )
-                    await resized.make(img)
+            for size, resized in variants:
+                logger.info(
+                    "resizing image: %s to size %d",
+                    os.path.basename(self.fpath),
+                    size,
+                )
+                resized.make(img)
+        self._forget_variants()
+        IMAGES.add_variants(self)
+
+    async def downsize(self):
+        missing = [
+            (size, resized)
+            for size, resized in self.variants
+            if not resized.exists or settings.args.get("regenerate")
+        ]
+        if not len(missing):
+            IMAGES.add_variants(self)
+            return
+
+        if settings.args.get("preview"):
+            for size, resized in missing:
+                LAZY[resized.fpath] = (self, resized)
+            return
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(IMGPOOL, self._downsize, missing)
+
+    def make_variant(self, resized):
+        """ make a single resized variant; used by the preview server """
+        if not self.is_duplicate:
+            self._downsize([(resized.size, resized)])
+            return
+        n = [r for s, r in self.variants].index(resized)
+        if self.primary is not self:
+            psize, presized = self.primary.variants[n]
+            if not presized.exists:
+                self.primary._downsize([(psize, presized)])
+        self._link(resized, self.presized[n])
+
+    def _link(self, resized, presized):
+        """ presized is the path of the file to link resized to """
+        self.__dict__.pop("jsonld", None)
+        if os.path.exists(resized.fpath):
+            if os.path.samefile(resized.fpath, presized):
+                return
+            os.unlink(resized.fpath)
+        elif not os.path.isdir(os.path.dirname(resized.fpath)):
+            os.makedirs(os.path.dirname(resized.fpath))
+        logger.info("linking %s to %s", presized, resized.fpath)
+        try:
+            os.link(presized, resized.fpath)
+        except OSError:
+            cp(presized, resized.fpath)
+
+    def link_variants(self):
+        """ hardlink the resized variants of the primary image - or of an
+        identical one from an earlier build - instead of making our own;
+        falls back to copy if linking is not possible """
+        for (size, resized), presized in zip(
+            self.variants, self.presized
+        ):
+            if not os.path.exists(presized):
+                logger.error("missing resized image %s", presized)
+                continue
+            self._link(resized, presized)
 
     class Resized:
         def __init__(self, parent, size, crop=False):
@@ -752,6 +1805,10 @@ class WebImage(object):
 
         @property
         def suffix(self):
+            if self.crop:
+                return settings.photo.get("thumbnails").get(
+                    self.size, ""
+                )
             return settings.photo.get("sizes").get(self.size, "")
 
         @property
@@ -795,10 +1852,14 @@ class WebImage(object):
 
         @property
         def width(self):
+            if self.crop:
+                return self.size
             return self.dimensions[0]
 
         @property
         def height(self):
+            if self.crop:
+                return self.size
             return self.dimensions[1]
 
         @property
@@ -829,20 +1890,23 @@ class WebImage(object):
                 w = int(float(size / height) * width)
             return (w, h)
 
-        async def make(self, original):
+        def make(self, original):
             if not os.path.isdir(os.path.dirname(self.fpath)):
                 os.makedirs(os.path.dirname(self.fpath))
 
             with original.clone() as thumb:
-                thumb.resize(self.width, self.height)
+                w, h = self.dimensions
+                thumb.resize(w, h)
 
+                # dimensions already made the shorter side self.size
                 if self.crop:
-                    thumb.liquid_rescale(self.size, self.size, 1, 1)
+                    thumb.crop(
+                        width=self.size,
+                        height=self.size,
+                        gravity="center",
+                    )
 
-                if (
-                    self.parent.meta.get("FileType", "jpeg").lower()
-                    == "jpeg"
-                ):
+                if self.parent.record["file_type"].lower() == "jpeg":
                     thumb.compression_quality = 88
                     thumb.unsharp_mask(
                         radius=1, sigma=0.5, amount=0.7, threshold=0.5
@@ -850,7 +1914,7 @@ class WebImage(object):
                     thumb.format = "pjpeg"
 
                 # this is to make sure pjpeg happens
-                with open(self.fpath, "wb") as f:
+                with atomicfile(self.fpath) as f:
                     logger.info("writing %s", self.fpath)
                     thumb.save(file=f)
 
@@ -897,6 +1961,11 @@ class Singular(MarkdownDoc):
             comments[comment.dt.timestamp] = comment
         return comments
 
+    @cached_property
+    def commentcount(self):
+        """ the catalog sets this from the comments it has counted """
+        return len(self.comments.keys())
+
     @cached_property
     def images(self):
         """
@@ -944,22 +2013,65 @@ class Singular(MarkdownDoc):
         else:
             return PandocMD2TXT(self.summary)
 
-    @property
-    def published(self):
+    @cached_property
+    def derived(self):
+        """
+        the cached, expensive bits of the post, keyed by the hash of the
+        markdown file; dates are stored as strings to keep their timezones
+        """
+        images = [img.hash for img in self.images.values()]
+        POSTS.use(self.hash)
+        r = POSTS.get(self.hash, None)
+        if r and r.get("images", None) == images:
+            return r
+        r = {
+            "lang": self._lang(),
+            "has_code": self._has_code(),
+            "is_photo": self._is_photo(),
+            "published": None,
+            "updated": None,
+            "shortslug": None,
+            "images": images,
+        }
+        # without a published date arrow falls back to now, which can't
+        # be cached
+        if self.meta.get("published"):
+            published = self._published()
+            r.update(
+                {
+                    "published": str(published),
+                    "shortslug": self.baseN(published.timestamp),
+                }
+            )
+        if "updated" in self.meta:
+            r.update(
+                {"updated": str(arrow.get(self.meta.get("updated")))}
+            )
+        POSTS[self.hash] = r
+        return r
+
+    def _published(self):
         # ok, so here's a hack: because I have no idea when my older photos
         # were actually published, any photo from before 2014 will have
         # the EXIF createdate as publish date
         pub = arrow.get(self.meta.get("published"))
-        if self.is_photo:
-            maybe = arrow.get(self.photo.exif.get("CreateDate"))
+        if self._is_photo():
+            photo = next(iter(self.images.values()))
+            maybe = arrow.get(photo.exif.get("CreateDate"))
             if maybe.year < settings.photo.earlyyears:
                 pub = maybe
         return pub
 
-    @property
+    @cached_property
+    def published(self):
+        if self.derived["published"]:
+            return arrow.get(self.derived["published"])
+        return self._published()
+
+    @cached_property
     def updated(self):
-        if "updated" in self.meta:
-            return arrow.get(self.meta.get("updated"))
+        if self.derived["updated"]:
+            return arrow.get(self.derived["updated"])
         else:
             return self.dt
 
@@ -988,6 +2100,9 @@ class Singular(MarkdownDoc):
 
     @property
     def is_photo(self):
+        return self.derived["is_photo"]
+
+    def _is_photo(self):
         """
         This is true if there is a file, with the same name as the entry's
         directory - so, it's slug -, and that that image believes it's a a
@@ -1045,6 +2160,8 @@ class Singular(MarkdownDoc):
 
     @property
     def shortslug(self):
+        if self.derived["shortslug"]:
+            return self.derived["shortslug"]
         return self.baseN(self.published.timestamp)
 
     @property
@@ -1087,9 +2204,14 @@ class Singular(MarkdownDoc):
 
     @property
     def lang(self):
-        lang = "en"
+        return self.derived["lang"]
+
+    def _lang(self):
+        if self.meta.get("lang"):
+            return self.meta.get("lang")
+        lang = settings.lang.default
         try:
-            lang = langdetect.detect(
+            lang = LANG.detect(
                 "\n".join([self.meta.get("title", ""), self.content])
             )
         except BaseException:
@@ -1102,6 +2224,9 @@ class Singular(MarkdownDoc):
 
     @property
     def has_code(self):
+        return self.derived["has_code"]
+
+    def _has_code(self):
         if RE_CODE.search(self.content):
             return True
         else:
@@ -1150,6 +2275,61 @@ class Singular(MarkdownDoc):
         }
         return r
 
+    @cached_property
+    def ldtype(self):
+        if self.is_photo:
+            return "Photograph"
+        elif self.has_code:
+            return "TechArticle"
+        elif self.is_page:
+            return "WebPage"
+        return "Article"
+
+    @cached_property
+    def listing(self):
+        """
+        The part of jsonld archive pages - meta-article.j2.html - show of a
+        post: no full text, comments or image data, so listing a category
+        doesn't convert every post in it.
+        """
+        r = {
+            "@type": self.ldtype,
+            "inLanguage": self.lang,
+            "headline": self.title,
+            "url": self.url,
+            "genre": self.category,
+            "name": self.name,
+            "dateModified": str(self.dt),
+            "datePublished": str(self.published),
+            "copyrightYear": str(self.published.format("YYYY")),
+            "author": settings.author,
+            "description": self.html_summary,
+            "text": "",
+            "image": [],
+            "commentCount": self.commentcount,
+        }
+
+        # the template falls back to text|truncate(255) without a summary,
+        # which never looks past the first 255 + 5 (leeway) characters
+        if not len(r["description"]):
+            r["text"] = self.html_content[:261]
+
+        if self.is_photo:
+            for img in self.images.values():
+                if img.is_mainimg:
+                    r["image"].append(
+                        {"representativeOfPage": True, "text": str(img)}
+                    )
+
+        if len(self.images):
+            thumbnail = next(iter(self.images.values())).thumbnail
+            r["thumbnailUrl"] = thumbnail.url if thumbnail else ""
+
+        if self.is_reply:
+            r["mentions"] = {"url": self.is_reply}
+
+        return settings.nameddict(r)
+
     @cached_property
     def jsonld(self):
         r = {
@@ -1174,16 +2354,11 @@ class Singular(MarkdownDoc):
             "description": self.html_summary,
             "potentialAction": [],
             "comment": [],
-            "commentCount": len(self.comments.keys()),
+            "commentCount": self.commentcount,
             "keywords": self.tags,
         }
 
-        if self.is_photo:
-            r.update({"@type": "Photograph"})
-        elif self.has_code:
-            r.update({"@type": "TechArticle"})
-        elif self.is_page:
-            r.update({"@type": "WebPage"})
+        r.update({"@type": self.ldtype})
         if len(self.images):
             r["image"] = []
             for img in list(self.images.values()):
@@ -1218,7 +2393,10 @@ class Singular(MarkdownDoc):
             )
 
         for mtime in sorted(self.comments.keys()):
-            r["comment"].append(self.comments[mtime].jsonld)
+            comment = self.comments[mtime]
+            r["comment"].append(
+                dict(comment.jsonld, text=comment.html(self.url))
+            )
 
         return settings.nameddict(r)
 
@@ -1230,6 +2408,32 @@ class Singular(MarkdownDoc):
     def txttemplate(self):
         return f"{self.__class__.__name__}.j2.txt"
 
+    @property
+    def feedinputs(self):
+        """ everything the feed entries of the post are made from; the
+        enclosure length is the size of the resized photo, which the hash
+        of the original doesn't cover """
+        return [
+            self.hash,
+            str(self.dt),
+            str(self.published),
+            [img.hash for img in self.images.values()],
+            self.photo.mime_size if self.is_photo else None,
+            HIGHLIGHTER.enabled,
+            FRAGMENTS.template("WebImage.j2.html"),
+            settings.author,
+        ]
+
+    @property
+    def templates(self):
+        """ the images and comments in the page are rendered separately """
+        return [
+            self.template,
+            self.txttemplate,
+            "WebImage.j2.html",
+            "Comment.j2.html",
+        ]
+
     @property
     def renderdir(self):
         return os.path.join(settings.paths.get("build"), self.name)
@@ -1242,22 +2446,36 @@ class Singular(MarkdownDoc):
     def txtfile(self):
         return os.path.join(self.renderdir, settings.filenames.txt)
 
+    @property
+    def sources(self):
+        """
+        names, mtimes and sizes of everything in the directory of the post,
+        from stat calls only: this is what the manifest is checked against
+        """
+        r = {}
+        with os.scandir(self.dirpath) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                stat = entry.stat()
+                r[entry.name] = [int(stat.st_mtime), stat.st_size]
+        return r
+
     @property
     def exists(self):
         if settings.args.get("force"):
             logger.debug("rendering required: force mode on")
             return False
-        maybe = self.dt.timestamp
-        if len(self.files):
-            for f in self.files:
-                maybe = max(maybe, mtime(f))
         for f in [self.renderfile, self.txtfile]:
             if not os.path.exists(f):
                 logger.debug(f"rendering required: no {f} yet")
                 return False
-            elif maybe > mtime(f):
-                logger.debug(f"rendering required: self.dt > {f} mtime")
-                return False
+        built = MANIFEST.get(self.renderfile, {}).get("sources", None)
+        if built != self.sources:
+            logger.debug("rendering required: sources changed")
+            return False
+        if TEMPLATES.changed(self.renderfile, self.templates):
+            return False
         logger.debug("rendering not required")
         return True
 
@@ -1298,6 +2516,10 @@ class Singular(MarkdownDoc):
             cp(f, t)
 
     async def render_map(self):
+        mapfpath = os.path.join(self.dirpath, "map.png")
+        if os.path.exists(mapfpath):
+            return
+
         if not self.is_photo:
             return
 
@@ -1319,10 +2541,6 @@ class Singular(MarkdownDoc):
             3,
         )
         token = keys.mapbox.get("private")
-        mapfpath = os.path.join(self.dirpath, "map.png")
-        if os.path.exists(mapfpath):
-            return
-
         url = f"https://api.mapbox.com/styles/v1/mapbox/{style}/static/pin-s({lon},{lat})/{lon},{lat},11,20/{size}?access_token={token}"
         logger.info("requesting map for %s with URL %s", self.name, url)
         with requests.get(url, stream=True) as r:
@@ -1364,6 +2582,7 @@ class Singular(MarkdownDoc):
         if self.exists:
             return True
 
+        sources = self.sources
         logger.info("rendering %s", self.name)
         v = {
             "baseurl": self.url,
@@ -1373,8 +2592,12 @@ class Singular(MarkdownDoc):
             "meta": settings.meta,
             "fnames": settings.filenames,
         }
-        writepath(
-            self.renderfile, J2.get_template(self.template).render(v)
+        streampath(
+            self.renderfile,
+            minified(
+                J2.get_template(self.template).stream(v),
+                self.__class__.__name__,
+            ),
         )
         del v
 
@@ -1387,6 +2610,10 @@ class Singular(MarkdownDoc):
             self.txtfile, J2.get_template(self.txttemplate).render(g)
         )
         del g
+        MANIFEST[self.renderfile] = dict(
+            MANIFEST.get(self.renderfile, {}), sources=sources
+        )
+        TEMPLATES.record(self.renderfile, self.templates)
 
 
 class Home(Singular):
@@ -1421,7 +2648,7 @@ class Home(Singular):
 
         for mtime in sorted(order.keys(), reverse=True):
             category = self.cdata[order[mtime]].ctmplvars
-            post = self.pdata[order[mtime]].jsonld
+            post = self.pdata[order[mtime]].listing
             flattened.append((category, post))
 
         return flattened
@@ -1439,10 +2666,32 @@ class Home(Singular):
     @property
     def dt(self):
         ts = 0
-        for cat, post in self.posts:
-            ts = max(ts, arrow.get(post["dateModified"]).timestamp)
+        for post in self.pdata.values():
+            ts = max(ts, post.dt.timestamp)
         return arrow.get(ts)
 
+    @property
+    def exists(self):
+        """ the home page depends on the newest posts, not on its own
+        directory, so this stays a date comparison """
+        if settings.args.get("force"):
+            return False
+        if not os.path.exists(self.renderfile):
+            return False
+        maybe = max(self.dt.timestamp, self.mtime)
+        for f in self.files:
+            maybe = max(maybe, mtime(f))
+        if maybe > mtime(self.renderfile):
+            return False
+        if TEMPLATES.changed(self.renderfile, self.templates):
+            return False
+        return True
+
+    @property
+    def templates(self):
+        """ photo listings carry their rendered images """
+        return [self.template, "WebImage.j2.html"]
+
     async def render_gopher(self):
         lines = ["%s's gopherhole" % (settings.site.name), "", ""]
 
@@ -1477,7 +2726,8 @@ class Home(Singular):
                 "fnames": settings.filenames,
             }
         )
-        writepath(self.renderfile, r)
+        writepath(self.renderfile, minify(r, self.__class__.__name__))
+        TEMPLATES.record(self.renderfile, self.templates)
         await self.render_gopher()
 
 
@@ -1619,6 +2869,204 @@ class Search(PHPFile):
             writepath(target, r)
 
 
+class Catalog(object):
+    """
+    SQLite catalog of every post and comment, holding what the categories,
+    the world map, the sitemap and the stats need. A post's row is only
+    recalculated when the stat signature of its directory changes, so
+    unchanged posts are never parsed for any of these.
+    """
+
+    def __init__(self):
+        self.fpath = os.path.join(settings.tmpdir, "catalog.sqlite")
+        self.db = sqlite3.connect(self.fpath)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode = MEMORY;")
+        self.db.execute("PRAGMA temp_store = MEMORY;")
+        self.db.execute('PRAGMA encoding = "UTF-8";')
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS posts (
+                fpath TEXT PRIMARY KEY,
+                name TEXT,
+                category TEXT,
+                sources TEXT,
+                hash TEXT,
+                derived TEXT,
+                published INTEGER,
+                dt INTEGER,
+                mtime INTEGER,
+                title TEXT,
+                url TEXT,
+                is_page INTEGER,
+                is_front INTEGER,
+                tags TEXT,
+                pings TEXT,
+                latitude REAL,
+                longitude REAL,
+                thumbnail TEXT,
+                variants TEXT
+            )"""
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS comments (
+                fpath TEXT PRIMARY KEY,
+                post TEXT,
+                published INTEGER,
+                type TEXT
+            )"""
+        )
+        self.jsoncolumns = [
+            "sources",
+            "derived",
+            "tags",
+            "pings",
+            "variants",
+        ]
+        self.seen = {}
+        self.commentcounts = {
+            row["post"]: row["count"]
+            for row in self.db.execute(
+                "SELECT post, COUNT(*) AS count FROM comments GROUP BY post"
+            )
+        }
+
+    def __exit__(self):
+        self.db.commit()
+        self.db.close()
+
+    def entry(self, post, sources):
+        """ everything about a post that goes into the catalog; this is
+        the part that parses the post """
+        r = {
+            "fpath": post.fpath,
+            "name": post.name,
+            "category": post.category,
+            "sources": sources,
+            "hash": post.hash,
+            "derived": post.derived,
+            "published": post.published.timestamp,
+            "dt": post.dt.timestamp,
+            "mtime": post.mtime,
+            "title": post.title,
+            "url": post.url,
+            "is_page": post.is_page,
+            "is_front": bool(post.is_front),
+            "tags": post.tags,
+            "pings": [w.target for w in post.to_ping],
+            "latitude": None,
+            "longitude": None,
+            "thumbnail": None,
+            "variants": [
+                resized.fpath
+                for img in post.images.values()
+                for size, resized in img.variants
+            ],
+        }
+        if post.is_photo and post.photo.jsonld.locationCreated:
+            geo = post.photo.jsonld.locationCreated.geo
+            r.update(
+                {
+                    "latitude": geo.latitude,
+                    "longitude": geo.longitude,
+                    "thumbnail": post.photo.jsonld.thumbnailUrl
+                    or post.photo.src,
+                }
+            )
+        return r
+
+    def update(self, post):
+        """ returns the catalog entry of the post, recalculated if the
+        files of the post changed since the last build """
+        self.seen[post.fpath] = True
+        sources = post.sources
+        row = self.db.execute(
+            "SELECT * FROM posts WHERE fpath = ?", (post.fpath,)
+        ).fetchone()
+        if (
+            row
+            and json.loads(row["sources"]) == sources
+            and not settings.args.get("force")
+        ):
+            r = dict(row)
+            for k in self.jsoncolumns:
+                r[k] = json.loads(r[k])
+            r["is_changed"] = False
+        else:
+            logger.debug("updating catalog entry of %s", post.name)
+            r = self.entry(post, sources)
+            columns = list(r.keys())
+            self.db.execute(
+                "INSERT OR REPLACE INTO posts (%s) VALUES (%s)"
+                % (",".join(columns), ",".join(["?"] * len(columns))),
+                [
+                    json.dumps(r[k]) if k in self.jsoncolumns else r[k]
+                    for k in columns
+                ],
+            )
+            self.db.execute(
+                "DELETE FROM comments WHERE post = ?", (post.fpath,)
+            )
+            for comment in post.comments.values():
+                self.db.execute(
+                    "INSERT OR REPLACE INTO comments VALUES (?,?,?,?)",
+                    (
+                        comment.fpath,
+                        post.fpath,
+                        comment.dt.timestamp,
+                        comment.type,
+                    ),
+                )
+            self.commentcounts[post.fpath] = len(post.comments)
+            r["is_changed"] = True
+
+        # anything the catalog knows doesn't need to be calculated again
+        post.hash = r["hash"]
+        post.derived = r["derived"]
+        post.commentcount = self.commentcounts.get(post.fpath, 0)
+        POSTS.use(post.hash)
+        return settings.nameddict(r)
+
+    def prune(self):
+        """ drop the posts that were not seen during this build """
+        for row in self.db.execute(
+            "SELECT fpath FROM posts"
+        ).fetchall():
+            if row["fpath"] in self.seen:
+                continue
+            logger.info("removing %s from catalog", row["fpath"])
+            self.db.execute(
+                "DELETE FROM posts WHERE fpath = ?", (row["fpath"],)
+            )
+            self.db.execute(
+                "DELETE FROM comments WHERE post = ?", (row["fpath"],)
+            )
+
+    @property
+    def postcount(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM posts WHERE published <= ?",
+            (arrow.utcnow().timestamp,),
+        ).fetchone()[0]
+
+    @property
+    def commentcount(self):
+        return self.db.execute(
+            """
+            SELECT
+                COUNT(*)
+            FROM
+                comments
+            JOIN
+                posts ON comments.post = posts.fpath
+            WHERE
+                posts.published <= ?
+        """,
+            (arrow.utcnow().timestamp,),
+        ).fetchone()[0]
+
+
 class IndexPHP(PHPFile):
     def __init__(self):
         self.gone = {}
@@ -1698,22 +3146,19 @@ class WorldMap(object):
         self.data = {}
         self.mtime = 0
 
-    def add(self, post):
-        if not post.is_photo:
-            return
-        if not post.photo.jsonld.locationCreated:
+    def add(self, entry):
+        """ add a post by its catalog entry """
+        if entry.latitude is None or entry.longitude is None:
             return
 
-        lat = post.photo.jsonld.locationCreated.geo.latitude
-        lon = post.photo.jsonld.locationCreated.geo.longitude
-        k = (lat, lon)
-        content = f'<p><a href="{post.url}"><img src="{post.photo.src}" style="width: 150px; height: auto" /><br />{post.title}</a></p>'
+        k = (entry.latitude, entry.longitude)
+        content = f'<p><a href="{entry.url}"><img src="{entry.thumbnail}" style="width: 150px; height: auto" /><br />{entry.title}</a></p>'
         # d = {"latitude": nlat, "longitude": nlon, "popup": content}
         if k in self.data:
             self.data[k].append(content)
         else:
             self.data[k] = [content]
-        self.mtime = max(post.dt.timestamp, self.mtime)
+        self.mtime = max(entry.dt, self.mtime)
 
     @property
     def exists(self):
@@ -1721,6 +3166,8 @@ class WorldMap(object):
             return False
         if not os.path.exists(self.renderfile):
             return False
+        if TEMPLATES.changed(self.renderfile, [self.template]):
+            return False
         if mtime(self.renderfile) >= self.mtime:
             return True
         return False
@@ -1754,8 +3201,12 @@ class WorldMap(object):
         )
         writepath(
             self.renderfile,
-            J2.get_template(self.template).render(self.tmplvars),
+            minify(
+                J2.get_template(self.template).render(self.tmplvars),
+                self.__class__.__name__,
+            ),
         )
+        TEMPLATES.record(self.renderfile, [self.template])
 
 
 class Category(dict):
@@ -1810,15 +3261,20 @@ class Category(dict):
 
     @property
     def newest_year(self):
-        return arrow.get(max(self.keys())).format("YYYY")
+        return epoch2year(max(self.keys()))
+
+    @cached_property
+    def yearbuckets(self):
+        """ post keys grouped by their UTC year, newest first """
+        buckets = {}
+        for key in self.sortedkeys:
+            buckets.setdefault(epoch2year(key), []).append(int(key))
+        return buckets
 
     @cached_property
     def years(self):
         years = {}
-        for key in list(sorted(self.keys(), reverse=True)):
-            year = arrow.get(int(key)).format("YYYY")
-            if year in years:
-                continue
+        for year in self.yearbuckets.keys():
             if year == self.newest_year:
                 url = f"{self.url}{settings.filenames.html}"
             else:
@@ -1860,12 +3316,20 @@ class Category(dict):
                 settings.filenames.json,
             )
 
+        @property
+        def templates(self):
+            """ no template of its own, but the entries carry the rendered
+            images of the posts """
+            return ["WebImage.j2.html"]
+
         @property
         def exists(self):
             if settings.args.get("force"):
                 return False
             if not os.path.exists(self.renderfile):
                 return False
+            if TEMPLATES.changed(self.renderfile, self.templates):
+                return False
             if mtime(self.renderfile) >= self.mtime:
                 return True
             return False
@@ -1898,30 +3362,43 @@ class Category(dict):
                 0 : settings.pagination
             ]:
                 post = self.parent[key]
-                pjs = {
-                    "id": post.url,
-                    "content_text": post.txt_content,
-                    "content_html": post.html_content,
-                    "url": post.url,
-                    "date_published": str(post.published),
-                }
-                if len(post.summary):
-                    pjs.update({"summary": post.txt_summary})
-                if post.is_photo:
-                    pjs.update(
-                        {
-                            "attachment": {
-                                "url": post.photo.href,
-                                "mime_type": post.photo.mime_type,
-                                "size_in_bytes": f"{post.photo.mime_size}",
-                            }
-                        }
+                js["items"].append(
+                    json.loads(
+                        FRAGMENTS.get(
+                            "json",
+                            post.feedinputs,
+                            lambda: json.dumps(self.item(post)),
+                        )
                     )
-                js["items"].append(pjs)
+                )
             writepath(
                 self.renderfile,
                 json.dumps(js, indent=4, ensure_ascii=False),
             )
+            TEMPLATES.record(self.renderfile, self.templates)
+
+        def item(self, post):
+            """ the JSON feed item of a post """
+            pjs = {
+                "id": post.url,
+                "content_text": post.txt_content,
+                "content_html": post.html_content,
+                "url": post.url,
+                "date_published": str(post.published),
+            }
+            if len(post.summary):
+                pjs.update({"summary": post.txt_summary})
+            if post.is_photo:
+                pjs.update(
+                    {
+                        "attachment": {
+                            "url": post.photo.href,
+                            "mime_type": post.photo.mime_type,
+                            "size_in_bytes": f"{post.photo.mime_size}",
+                        }
+                    }
+                )
+            return pjs
 
     class XMLFeed(object):
         def __init__(self, parent):
@@ -1932,7 +3409,7 @@ class Category(dict):
             fe.id(post.url)
             fe.title(post.title)
             fe.published(post.published.datetime)
-            fe.updated(arrow.get(post.dt).datetime)
+            fe.updated(post.dt.datetime)
             lname = post.licence.upper()
             lyear = post.published.format("YYYY")
             fe.rights(f"{lname} {settings.author.name} {lyear}")
@@ -1943,7 +3420,7 @@ class Category(dict):
                 }
             )
             categories = []
-            for tag in set(post.tags):
+            for tag in sorted(set(post.tags)):
                 categories.append(
                     {
                         "term": tag
@@ -1980,12 +3457,20 @@ class Category(dict):
                 self.parent.renderdir, settings.paths.feed, "index.xml"
             )
 
+        @property
+        def templates(self):
+            """ no template of its own, but the entries carry the rendered
+            images of the posts """
+            return ["WebImage.j2.html"]
+
         @property
         def exists(self):
             if settings.args.get("force"):
                 return False
             if not os.path.exists(self.renderfile):
                 return False
+            if TEMPLATES.changed(self.renderfile, self.templates):
+                return False
             if mtime(self.renderfile) >= self.mtime:
                 return True
             return False
@@ -2004,6 +3489,41 @@ class Category(dict):
                 self.parent.name,
             )
 
+        def entry(self, post):
+            """ the serialized entry of post, made by make_entry - cached,
+            so the category and the front page feeds share it """
+            return FRAGMENTS.get(
+                self.__class__.__name__,
+                post.feedinputs,
+                lambda: self.serialize(self.make_entry(post)),
+            )
+
+        def assemble(self, fg, entries):
+            """ entries - newest first, as feedgen would prepend them -
+            spliced into the XML of the feed generated without entries """
+            head, tail = self.xml(fg).rsplit(self.closing, 1)
+            return "%s%s%s%s" % (
+                head,
+                "".join(entries),
+                self.closing,
+                tail,
+            )
+
+        async def render(self):
+            if self.exists:
+                self.uptodate()
+                return
+
+            self.notuptodate()
+            entries = [
+                self.entry(self.parent[key])
+                for key in reversed(self.rkeys)
+            ]
+            writepath(
+                self.renderfile, self.assemble(self.init_fg(), entries)
+            )
+            TEMPLATES.record(self.renderfile, self.templates)
+
         def init_fg(self):
             fg = FeedGenerator()
             fg.id(self.parent.feedurl)
@@ -2021,6 +3541,8 @@ class Category(dict):
             return fg
 
     class AtomFeed(XMLFeed):
+        closing = "</feed>"
+
         @property
         def renderfile(self):
             return os.path.join(
@@ -2029,29 +3551,26 @@ class Category(dict):
                 settings.filenames.atom,
             )
 
-        async def render(self):
-            if self.exists:
-                self.uptodate()
-                return
-
-            self.notuptodate()
-            fg = self.init_fg()
+        def make_entry(self, post):
+            fe = self.init_entry(post)
+            fe.link(href=post.url, rel="alternate", type="text/html")
+            # fe.content(src=post.url, type="text/html")
+            fe.content(post.html_content, type="html")
+            if len(post.summary):
+                fe.summary(post.summary)
+            return fe
 
-            for key in self.rkeys:
-                post = self.parent[key]
-                fe = self.init_entry(post)
-                fe.link(
-                    href=post.url, rel="alternate", type="text/html"
-                )
-                # fe.content(src=post.url, type="text/html")
-                fe.content(post.html_content, type="html")
-                if len(post.summary):
-                    fe.summary(post.summary)
-                fg.add_entry(fe)
+        def serialize(self, fe):
+            return etree.tostring(
+                fe.atom_entry(), pretty_print=True, encoding="unicode"
+            )
 
-            writepath(self.renderfile, fg.atom_str(pretty=True))
+        def xml(self, fg):
+            return fg.atom_str(pretty=True).decode("utf-8")
 
     class RSSFeed(XMLFeed):
+        closing = "</channel>"
+
         @property
         def renderfile(self):
             return os.path.join(
@@ -2060,42 +3579,32 @@ class Category(dict):
                 settings.filenames.rss,
             )
 
-        async def render(self):
-            if self.exists:
-                self.uptodate()
-                return
-
-            self.notuptodate()
-            fg = self.init_fg()
+        def make_entry(self, post):
+            fe = self.init_entry(post)
+            fe.link(href=post.url)
+            fe.content(post.html_content, type="CDATA")
+            return fe
 
-            for key in self.rkeys:
-                post = self.parent[key]
-                fe = self.init_entry(post)
-                fe.link(href=post.url)
-                fe.content(post.html_content, type="CDATA")
-                fg.add_entry(fe)
+        def serialize(self, fe):
+            return etree.tostring(
+                fe.rss_entry(), pretty_print=True, encoding="unicode"
+            )
 
-            output = fg.rss_str(pretty=True)
-            writepath(self.renderfile, output)
+        def xml(self, fg):
+            return fg.rss_str(pretty=True).decode("utf-8")
 
     class Year(object):
         def __init__(self, parent, year):
             self.parent = parent
             self.year = str(year)
 
-        @cached_property
+        @property
         def keys(self):
-            year = arrow.get(self.year, "YYYY").to("utc")
-            keys = []
-            for key in list(sorted(self.parent.keys(), reverse=True)):
-                ts = arrow.get(int(key))
-                if ts <= year.ceil("year") and ts >= year.floor("year"):
-                    keys.append(int(key))
-            return keys
+            return self.parent.yearbuckets.get(self.year, [])
 
         @property
         def posttmplvars(self):
-            return [self.parent[key].jsonld for key in self.keys]
+            return [self.parent[key].listing for key in self.keys]
 
         @property
         def mtime(self):
@@ -2125,12 +3634,19 @@ class Category(dict):
         def template(self):
             return "%s.j2.html" % (self.__class__.__name__)
 
+        @property
+        def templates(self):
+            """ photo listings carry their rendered images """
+            return [self.template, "WebImage.j2.html"]
+
         @property
         def exists(self):
             if settings.args.get("force"):
                 return False
             if not os.path.exists(self.renderfile):
                 return False
+            if TEMPLATES.changed(self.renderfile, self.templates):
+                return False
             if mtime(self.renderfile) >= self.mtime:
                 return True
             return False
@@ -2166,9 +3682,16 @@ class Category(dict):
                 self.year,
                 self.parent.name,
             )
-            r = J2.get_template(self.template).render(self.tmplvars)
-            writepath(self.renderfile, r)
-            del r
+            streampath(
+                self.renderfile,
+                minified(
+                    J2.get_template(self.template).stream(
+                        self.tmplvars
+                    ),
+                    self.__class__.__name__,
+                ),
+            )
+            TEMPLATES.record(self.renderfile, self.templates)
 
     class Flat(object):
         def __init__(self, parent):
@@ -2177,7 +3700,7 @@ class Category(dict):
         @property
         def posttmplvars(self):
             return [
-                self.parent[key].jsonld
+                self.parent[key].listing
                 for key in list(
                     sorted(self.parent.keys(), reverse=True)
                 )
@@ -2197,12 +3720,19 @@ class Category(dict):
         def template(self):
             return "%s.j2.html" % (self.__class__.__name__)
 
+        @property
+        def templates(self):
+            """ photo listings carry their rendered images """
+            return [self.template, "WebImage.j2.html"]
+
         @property
         def exists(self):
             if settings.args.get("force"):
                 return False
             if not os.path.exists(self.renderfile):
                 return False
+            if TEMPLATES.changed(self.renderfile, self.templates):
+                return False
             if mtime(self.renderfile) >= self.mtime:
                 return True
             return False
@@ -2231,9 +3761,16 @@ class Category(dict):
                 )
                 return
             logger.info("rendering category %s", self.parent.name)
-            r = J2.get_template(self.template).render(self.tmplvars)
-            writepath(self.renderfile, r)
-            del r
+            streampath(
+                self.renderfile,
+                minified(
+                    J2.get_template(self.template).stream(
+                        self.tmplvars
+                    ),
+                    self.__class__.__name__,
+                ),
+            )
+            TEMPLATES.record(self.renderfile, self.templates)
 
     class Gopher(object):
         def __init__(self, parent):
@@ -2298,6 +3835,157 @@ class Category(dict):
             writepath(self.renderfile, "\r\n".join(lines))
 
 
+class Assets(dict):
+    """ maps the template name of a CSS or JS file to the URL of its
+    fingerprinted copy in the build directory; templates fall back to
+    inlining anything that's not in here """
+
+    def fname(self, name, content):
+        base, ext = os.path.splitext(name)
+        h = hashlib.sha1(content.encode("utf-8")).hexdigest()[:10]
+        return "%s.%s%s" % (base, h, ext)
+
+    def render(self):
+        if not settings.assets.external:
+            return
+        for name in settings.assets.files:
+            content = J2.get_template(name).render()
+            fname = self.fname(name, content)
+            target = os.path.join(settings.paths.get("build"), fname)
+            # old fingerprints stay: pages not re-rendered still use them
+            if not os.path.exists(target):
+                writepath(target, content)
+            self[name] = "%s/%s" % (settings.site.url, fname)
+
+
+ASSETS = Assets()
+J2.globals["assets"] = ASSETS
+
+
+class Chrome(object):
+    """
+    The parts of base.j2.html that are the same on every page - the head
+    links, the header and the footer - rendered once per build. The only
+    per page bits in them, relative URLs and the active menu item, are left
+    as markers and filled in for each page.
+    """
+
+    def __init__(self):
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    @cached_property
+    def env(self):
+        """ J2, but relurl leaves markers """
+        env = J2.overlay(cache_size=50)
+        env.filters = dict(J2.filters)
+        env.filters["relurl"] = lambda url, baseurl=None: (
+            "<!--relurl:%s-->" % url
+        )
+        return env
+
+    @property
+    def tmplvars(self):
+        return {
+            "site": settings.site,
+            "menu": settings.menu,
+            "meta": settings.meta,
+            "assets": ASSETS,
+        }
+
+    @cached_property
+    def settingshash(self):
+        """ settings don't change during a build, and assets are in place
+        before anything is rendered """
+        return hashlib.sha1(
+            json.dumps(
+                self.tmplvars, sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+
+    def render(self, name):
+        key = (name, FRAGMENTS.template(name), self.settingshash)
+        with self.lock:
+            if key not in self.rendered:
+                logger.debug("rendering site chrome %s", name)
+                self.rendered[key] = self.env.get_template(name).render(
+                    self.tmplvars
+                )
+            return self.rendered[key]
+
+    def part(self, name, baseurl, active=()):
+        html = RE_CHROMEURL.sub(
+            lambda m: relurl(m.group(1), baseurl), self.render(name)
+        )
+        return RE_CHROMEMENU.sub(
+            lambda m: 'class="active"' if m.group(1) in active else "",
+            html,
+        )
+
+
+CHROME = Chrome()
+J2.globals["chrome"] = CHROME
+
+
+class TemplateDeps(object):
+    """
+    The include/extends/import graph of the templates - plus the chrome
+    parts base.j2.html pulls in - and what outputs were made with: the
+    manifest keeps the hashes of every template an output used, so an edit
+    only invalidates the outputs that actually depend on that template.
+    """
+
+    def __init__(self):
+        self.graph = {}
+
+    def refs(self, name):
+        """ the templates name pulls in directly """
+        if name not in self.graph:
+            source, _, _ = J2.loader.get_source(J2, name)
+            refs = set(
+                jinja2.meta.find_referenced_templates(J2.parse(source))
+            )
+            refs.update(RE_CHROMEPART.findall(source))
+            # None is a name only known at render time
+            refs.discard(None)
+            self.graph[name] = refs
+        return self.graph[name]
+
+    def closure(self, names):
+        r = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name in r:
+                continue
+            r.add(name)
+            todo.extend(self.refs(name))
+        return r
+
+    def signature(self, names):
+        return {n: FRAGMENTS.template(n) for n in self.closure(names)}
+
+    def changed(self, renderfile, names):
+        built = MANIFEST.get(renderfile, {}).get("templates", None)
+        if built != self.signature(names):
+            logger.debug("rendering required: templates changed")
+            return True
+        return False
+
+    def record(self, renderfile, names):
+        entry = dict(MANIFEST.get(renderfile, {}))
+        if settings.args.get("preview"):
+            # made with the sizes of the originals in place of the resized
+            # images: the next normal build has to render it again
+            entry.pop("templates", None)
+        else:
+            entry["templates"] = self.signature(names)
+        MANIFEST[renderfile] = entry
+
+
+TEMPLATES = TemplateDeps()
+
+
 class Sitemap(dict):
     @property
     def mtime(self):
@@ -2306,8 +3994,9 @@ class Sitemap(dict):
             r = mtime(self.renderfile)
         return r
 
-    def append(self, post):
-        self[post.url] = post.mtime
+    def append(self, entry):
+        """ add a post by its catalog entry """
+        self[entry.url] = entry.mtime
 
     @property
     def renderfile(self):
@@ -2319,8 +4008,7 @@ class Sitemap(dict):
         if len(self) > 0:
             if self.mtime >= sorted(self.values())[-1]:
                 return
-            with open(self.renderfile, "wt") as f:
-                f.write("\n".join(sorted(self.keys())))
+            writepath(self.renderfile, "\n".join(sorted(self.keys())))
 
 
 class Webmention(object):
@@ -2468,6 +4156,75 @@ class Webmention(object):
                     return
 
 
+class PreviewHandler(http.server.SimpleHTTPRequestHandler):
+    """ serves the build directory; resized images registered in LAZY are
+    made on their first request and stay on disk afterwards """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(
+            *args, directory=settings.paths.get("build"), **kwargs
+        )
+
+    def send_head(self):
+        fpath = self.translate_path(self.path)
+        with LAZYLOCK:
+            entry = LAZY.pop(fpath, None)
+            if entry is not None:
+                job = LAZYJOBS[fpath] = Future()
+            else:
+                job = LAZYJOBS.get(fpath, None)
+        if entry is not None:
+            self.make(fpath, entry, job)
+        elif job is not None:
+            job.result()
+        return super().send_head()
+
+    def make(self, fpath, entry, job):
+        """ only the global lock is held for the bookkeeping, so different
+        images are made in parallel """
+        img, resized = entry
+        try:
+            if not resized.exists:
+                img.make_variant(resized)
+            job.set_result(fpath)
+        except BaseException as e:
+            # let the next request try again
+            with LAZYLOCK:
+                LAZY[fpath] = entry
+            job.set_exception(e)
+            raise
+        finally:
+            with LAZYLOCK:
+                del LAZYJOBS[fpath]
+
+
+def precompile():
+    """ compile every template - including the raw CSS and JS includes -
+    into the bytecode cache, so workers started afterwards only load them """
+    for name in J2.list_templates(
+        filter_func=lambda n: not n.endswith(".png")
+    ):
+        J2.get_template(name)
+    logger.info("templates compiled to %s", J2CACHE)
+
+
+def preview():
+    server = http.server.ThreadingHTTPServer(
+        (settings.preview.host, settings.preview.port), PreviewHandler
+    )
+    logger.info(
+        "serving %s at http://%s:%d/",
+        settings.paths.get("build"),
+        settings.preview.host,
+        settings.preview.port,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
 class WebmentionIO(object):
     def __init__(self):
         self.params = {
@@ -2596,15 +4353,24 @@ def make():
     start = int(round(time.time() * 1000))
     last = 0
 
+    if settings.args.get("precompile"):
+        precompile()
+
+    ASSETS.render()
+
     # get incoming webmentions
     if not (
         settings.args.get("offline") or settings.args.get("noservices")
     ):
         incoming = WebmentionIO()
         incoming.run()
+        # the new comments are read back by the posts below
+        WRITER.flush()
         # TODO get queued micropub posts?
 
     queue = AQ()
+    imgqueue = AQ()
+    duplicates = []
     outbox = []
     to_archive = []
 
@@ -2617,9 +4383,9 @@ def make():
     frontposts = Category()
     home = Home(settings.paths.get("home"))
     worldmap = WorldMap()
-    postcount = 0
-    commentcount = 0
     micropub = Micropub()
+    catalog = Catalog()
+    now = arrow.utcnow().timestamp
 
     for e in glob.glob(os.path.join(content, "*", "*.url")):
         post = Redirect(e)
@@ -2631,21 +4397,34 @@ def make():
         )
     ):
         post = Singular(e)
-        if not post.is_future:
-            postcount = postcount + 1
-            commentcount = commentcount + len(post.comments)
-            worldmap.add(post)
-            for i in post.to_ping:
+        entry = catalog.update(post)
+        is_future = entry.published > now
+        if not is_future:
+            worldmap.add(entry)
+            for target in entry.pings:
+                i = Webmention(
+                    entry.url, target, post.dirpath, entry.dt
+                )
                 outbox.append(i)
                 if not (
                     settings.args.get("offline")
                     or settings.args.get("noservices")
                 ):
                     queue.put(i.backfill_syndication())
-            micropub.add_tags(post.tags)
+            micropub.add_tags(entry.tags)
 
-        for i in post.images.values():
-            queue.put(i.downsize())
+        # images of unchanged posts are only loaded if any of their resized
+        # versions are missing
+        if (
+            entry.is_changed
+            or settings.args.get("regenerate")
+            or not all([os.path.exists(v) for v in entry.variants])
+        ):
+            for i in post.images.values():
+                if i.is_duplicate and not settings.args.get("preview"):
+                    duplicates.append(i)
+                else:
+                    imgqueue.put(i.downsize())
 
         # if not post.is_future and not post.has_archive:
         # to_archive.append(post.url)
@@ -2655,7 +4434,7 @@ def make():
         queue.put(post.copy_files())
 
         # skip draft posts from anything further
-        if post.is_future:
+        if is_future:
             logger.info("%s is for the future", post.name)
             continue
 
@@ -2663,28 +4442,34 @@ def make():
         search.append(post)
 
         # start populating sitemap
-        sitemap.append(post)
+        sitemap.append(entry)
 
         # populate redirects, if any
-        rules.add_redirect(post.shortslug, post.url)
+        rules.add_redirect(post.shortslug, entry.url)
 
         # any category starting with '_' are special: they shouldn't have a
         # category archive page
-        if post.is_page:
+        if entry.is_page:
             continue
 
         # populate the category with the post
-        if post.category not in categories:
-            categories[post.category] = Category(post.category)
-        categories[post.category][post.published.timestamp] = post
+        if entry.category not in categories:
+            categories[entry.category] = Category(entry.category)
+        categories[entry.category][entry.published] = post
 
         # add to front, if allowed
-        if post.is_front:
-            frontposts[post.published.timestamp] = post
+        if entry.is_front:
+            frontposts[entry.published] = post
 
     # commit to search database - this saves quite a few disk writes
     search.__exit__()
 
+    # drop deleted posts from the catalog
+    catalog.prune()
+    postcount = catalog.postcount
+    commentcount = catalog.commentcount
+    catalog.__exit__()
+
     # render search and sitemap
     queue.put(search.render())
     queue.put(sitemap.render())
@@ -2721,8 +4506,31 @@ def make():
     # micropub handler PHP
     queue.put(micropub.render())
 
+    # resize images first: the renders need the sizes of the resized files
+    imgqueue.run()
+    for i in duplicates:
+        i.link_variants()
+
     # render all the things!
     queue.run()
+    if settings.args.get("force"):
+        # everything was rendered: what the caches have beyond that is for
+        # content that changed or is gone since
+        IMAGES.prune()
+        HIGHLIGHTER.prune()
+        FRAGMENTS.prune()
+    IMAGES.save()
+    # every post went through the catalog: what's left is for old versions
+    POSTS.prune()
+    POSTS.save()
+    HIGHLIGHTER.save()
+    FRAGMENTS.save()
+    WRITER.flush()
+    COMPRESSOR.wait()
+    # the manifest has the hashes of the queued writes too: only save it
+    # once they are all on disk, or a failed write would be skipped as
+    # unchanged next time
+    MANIFEST.save()
 
     # copy static files
     for e in glob.glob(os.path.join(content, "*.*")):
@@ -2733,9 +4541,20 @@ def make():
         )
         maybe_copy(e, t)
 
+    HTMLMinifier.report()
+    logger.info(
+        "%d files written, %d unchanged ones skipped",
+        WRITES["written"],
+        WRITES["skipped"],
+    )
+
     end = int(round(time.time() * 1000))
     logger.info("process took %d ms" % (end - start))
 
+    if settings.args.get("preview"):
+        preview()
+        return
+
     if not settings.args.get("offline"):
         # upload site
         try:
@@ -2752,6 +4571,7 @@ def make():
             for wm in outbox:
                 queue.put(wm.send())
             queue.run()
+            WRITER.flush()
             logger.info("sending webmentions finished")
 
 
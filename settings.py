@@ -203,7 +203,80 @@ photo = nameddict(
             720: "",
             1280: "_b",
         },
+        # square, center cropped thumbnails
+        "thumbnails": {150: "_q"},
         "earlyyears": 2014,
+        # parallel resize workers
+        "workers": 4,
+        # images above this many pixels are decoded at a reduced scale and
+        # only "hugeworkers" of them are processed at the same time
+        "huge": 40 * 1000 * 1000,
+        "hugeworkers": 1,
+    }
+)
+
+# wand.resource.limits; memory, map and disk are in bytes, area is in pixels
+imagemagick = nameddict(
+    {
+        "memory": 512 * 1024 * 1024,
+        "map": 1024 * 1024 * 1024,
+        "area": 128 * 1000 * 1000,
+        "thread": 2,
+    }
+)
+
+# language detection: fallback language, langdetect seed and the number of
+# characters of a post to detect on; "lang" in the frontmatter overrides it
+lang = nameddict({"default": "en", "seed": 0, "sample": 2000})
+
+preview = nameddict({"host": "127.0.0.1", "port": 8000})
+
+# highlight code blocks at build time, with pygments, instead of shipping
+# prism.js to the browser
+highlight = nameddict({"build": True})
+
+# collapse whitespace and strip comments from rendered HTML pages
+minify = nameddict({"html": True})
+
+# threads writing the output files
+writer = nameddict({"workers": 4})
+
+# precompressed siblings of text outputs for nginx gzip_static and
+# brotli_static; brotli needs the brotli module
+compress = nameddict(
+    {
+        "gzip": True,
+        "brotli": True,
+        "extensions": [
+            ".html",
+            ".xml",
+            ".json",
+            ".txt",
+            ".css",
+            ".js",
+            ".svg",
+        ],
+        "minsize": 1024,
+        "workers": 2,
+    }
+)
+
+# CSS and JS from the templates directory written once into the build
+# directory under a content hashed name and linked instead of inlined into
+# every single page
+assets = nameddict(
+    {
+        "external": True,
+        "files": [
+            "style.css",
+            "style-alt.css",
+            "style-konami.css",
+            "style-print.css",
+            "prism.css",
+            "themeswitcher.js",
+            "konami.js",
+            "prism.js",
+        ],
     }
 )
 
@@ -266,6 +339,8 @@ _booleanparams = {
     "offline": "offline mode - no syncing, no querying services, etc.",
     "noping": "make dummy webmention entries and don't really send them",
     "noservices": "skip querying any service but do sync the website",
+    "preview": "serve the build locally, resize images on first request",
+    "precompile": "compile all templates into the bytecode cache first",
 }
 
 for k, v in _booleanparams.items():
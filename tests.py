@@ -10,6 +10,12 @@ import exiftool
 import nasg
 import os
 import json
+import tempfile
+import timeit
+import asyncio
+import arrow
+import jinja2
+from lxml import etree
 
 class TestNASG(unittest.TestCase):
     def test_url2slug(self):
@@ -17,6 +23,202 @@ class TestNASG(unittest.TestCase):
         o = 'boffosockocom20171028content-bloat-privacy-archives-peter-molnar'
         self.assertEqual(nasg.url2slug(i), o)
 
+class TestRelurl(unittest.TestCase):
+    baseurl = '%s/some-article/' % nasg.settings.site.url
+
+    def linkdense(self, links=2000):
+        url = nasg.settings.site.url
+        html = ['<p>']
+        for i in range(links):
+            html.append(
+                '<a href="%s/post-%d/">post %d</a> and '
+                '<img src="%s/post-%d/photo_b.jpg" /> and '
+                '<a href="https://example.com/%d">elsewhere</a>'
+                % (url, i % 300, i, url, i % 300, i)
+            )
+        html.append('</p>')
+        return '\n'.join(html)
+
+    def reference(self, text, baseurl):
+        """ the original, replace per match implementation """
+        for match, standalone, href in nasg.RE_MYURL.findall(text):
+            url = href if len(href) else standalone
+            r = os.path.relpath(url, baseurl)
+            if url.endswith('/') and not r.endswith('/'):
+                r = '%s/%s' % (r, nasg.settings.filenames.html)
+            if len(href):
+                r = '"%s"' % r
+            text = text.replace(match, r)
+        return text
+
+    def test_relurl(self):
+        text = self.linkdense()
+        self.assertEqual(
+            nasg.relurl(text, self.baseurl),
+            self.reference(text, self.baseurl)
+        )
+
+    def test_relurl_standalone(self):
+        url = '%s/category/photo/' % nasg.settings.site.url
+        self.assertEqual(
+            nasg.relurl(url, self.baseurl),
+            self.reference(url, self.baseurl)
+        )
+
+    @unittest.skipUnless(
+        os.environ.get('NASG_BENCH'), 'set NASG_BENCH=1 to run benchmarks'
+    )
+    def test_relurl_benchmark(self):
+        """ timings only, nothing is asserted """
+        text = self.linkdense()
+        for name, f in [('relurl', nasg.relurl), ('before', self.reference)]:
+            t = min(timeit.repeat(
+                lambda: f(text, self.baseurl), number=1, repeat=3
+            ))
+            print('%s on %d bytes: %.4fs' % (name, len(text), t))
+
+class TestHTMLMinifier(unittest.TestCase):
+    page = """<div>
+    <p>a   b <!-- gone -->
+        c</p>
+    <pre><code>x   =   1
+      y</code></pre>
+    <textarea>  keep
+  me </textarea>
+    <!--[if lt IE 9]><script src="x.js"></script><![endif]-->
+</div>"""
+
+    def test_minify(self):
+        self.assertEqual(
+            nasg.minify(self.page, 'test'),
+            '<div>\n<p>a b \nc</p>\n'
+            '<pre><code>x   =   1\n      y</code></pre>\n'
+            '<textarea>  keep\n  me </textarea>\n'
+            '<!--[if lt IE 9]><script src="x.js"></script><![endif]-->\n'
+            '</div>'
+        )
+
+    def test_chunked(self):
+        whole = nasg.minify(self.page, 'test')
+        for size in range(1, len(self.page)):
+            m = nasg.HTMLMinifier('test')
+            chunked = ''.join(
+                m.feed(self.page[i:i + size])
+                for i in range(0, len(self.page), size)
+            ) + m.close()
+            self.assertEqual(chunked, whole)
+
+class TestMarkdownHeader(unittest.TestCase):
+    """ the header parser gives what frontmatter.parse used to """
+    cases = [
+        (
+            '---\ntitle: A post\ntags:\n- a\n---\n\nThe body.\n',
+            {'title': 'A post', 'tags': ['a']},
+            'The body.'
+        ),
+        ('Just a body.\n', {}, 'Just a body.'),
+        (
+            '---\ntitle: A post\n\nThe body.\n',
+            {},
+            '---\ntitle: A post\n\nThe body.'
+        ),
+        ('---\n---\nThe body.\n', {}, 'The body.'),
+        (
+            '\n\n---\ntitle: A post\n---\nThe body.\n',
+            {'title': 'A post'},
+            'The body.'
+        ),
+        ('', {}, ''),
+        (
+            '---\ntitle: A post\n---\nThe body.\n\n---\n\nMore.\n',
+            {'title': 'A post'},
+            'The body.\n\n---\n\nMore.'
+        ),
+    ]
+
+    def test_header(self):
+        for text, meta, content in self.cases:
+            with tempfile.NamedTemporaryFile('w', suffix='.md') as f:
+                f.write(text)
+                f.flush()
+                doc = nasg.MarkdownDoc(f.name)
+                self.assertEqual(doc.meta, meta, text)
+                self.assertEqual(doc.content, content, text)
+
+class StubPost(object):
+    """ what the feeds use of a Singular """
+    def __init__(self, n, html):
+        self.url = 'https://example.net/post-%d/' % n
+        self.title = 'post %d' % n
+        self.published = arrow.get(1500000000 + n * 86400)
+        self.dt = self.published
+        self.licence = 'CC-BY-4.0'
+        self.tags = ['b', 'a']
+        self.is_photo = False
+        self.summary = ''
+        self.html_content = html
+        self.feedinputs = [self.url, html]
+
+class TestFeeds(unittest.TestCase):
+    """ entries are spliced into the feeds from the fragment cache """
+    contents = ['<p>one</p>', '<p>x ]]> y</p>', '<p>three</p>']
+
+    def setUp(self):
+        self.build = tempfile.TemporaryDirectory()
+        self.oldbuild = nasg.settings.paths['build']
+        nasg.settings.paths['build'] = self.build.name
+        self.oldloader = nasg.J2.loader
+        nasg.J2.loader = jinja2.FileSystemLoader(
+            os.path.join(os.path.dirname(__file__), 'templates')
+        )
+        self.category = nasg.Category('test')
+        for n, html in enumerate(self.contents):
+            post = StubPost(n, html)
+            self.category[post.published.timestamp] = post
+
+    def tearDown(self):
+        nasg.WRITER.flush()
+        nasg.settings.paths['build'] = self.oldbuild
+        nasg.J2.loader = self.oldloader
+        self.build.cleanup()
+
+    def render(self, feed):
+        # twice: the second one is made from the cached entries
+        for i in range(2):
+            if os.path.exists(feed.renderfile):
+                os.unlink(feed.renderfile)
+            asyncio.run(feed.render())
+            nasg.WRITER.flush()
+            with open(feed.renderfile, 'rb') as f:
+                yield etree.fromstring(f.read())
+
+    def test_rss(self):
+        feed = self.category.RSSFeed(self.category)
+        for xml in self.render(feed):
+            items = xml.findall('channel/item')
+            self.assertEqual(
+                [i.findtext('title') for i in items],
+                ['post 2', 'post 1', 'post 0']
+            )
+            self.assertEqual(
+                [i.findtext('description') for i in items],
+                list(reversed(self.contents))
+            )
+
+    def test_atom(self):
+        ns = {'a': 'http://www.w3.org/2005/Atom'}
+        feed = self.category.AtomFeed(self.category)
+        for xml in self.render(feed):
+            entries = xml.findall('a:entry', ns)
+            self.assertEqual(
+                [e.findtext('a:title', namespaces=ns) for e in entries],
+                ['post 2', 'post 1', 'post 0']
+            )
+            self.assertEqual(
+                [e.findtext('a:content', namespaces=ns) for e in entries],
+                list(reversed(self.contents))
+            )
+
 class TestSingular(unittest.TestCase):
     singular = nasg.Singular('tests/index.md')
 